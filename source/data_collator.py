@@ -6,29 +6,31 @@ Author: @DvdNss
 Created on 11/15/2021
 """
 
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import torch
+from torch.nn.functional import pad
+from torch.nn.utils.rnn import pad_sequence
 from transformers import (
-    MT5Tokenizer,
+    MT5TokenizerFast,
 )
 
 
-def trim_batch(input_ids, pad_token_id, attention_mask=None):
+def pad_batch(sequences: List[torch.Tensor], pad_token_id: int, max_length: Optional[int] = None) -> torch.Tensor:
     """
-    Remove columns that are populated exclusively by pad_token_id.
+    Pads sequences to the longest one, or to max_length if given.
 
-    :param input_ids: input ids
+    :param sequences: list of variable-length sequences
     :param pad_token_id: pad token id
-    :param attention_mask: attention mask
-    :return: input_ids and eventually attention mask
+    :param max_length: fixed length of the padded batch
+    :return: padded batch
     """
 
-    keep_column_mask = input_ids.ne(pad_token_id).any(dim=0)
-    if attention_mask is None:
-        return input_ids[:, keep_column_mask]
-    else:
-        return input_ids[:, keep_column_mask], attention_mask[:, keep_column_mask]
+    padded = pad_sequence(sequences, batch_first=True, padding_value=pad_token_id)
+    if max_length is not None and padded.size(1) < max_length:
+        padded = pad(padded, (0, max_length - padded.size(1)), value=pad_token_id)
+
+    return padded
 
 
 class DataCollator:
@@ -36,18 +38,23 @@ class DataCollator:
     Data collator.
     """
 
-    def __init__(self, tokenizer: MT5Tokenizer, mode: str = 'training', using_tpu: bool = False) -> None:
+    def __init__(self, tokenizer: MT5TokenizerFast, mode: str = 'training', using_tpu: bool = False,
+                 source_max_length: Optional[int] = None, target_max_length: Optional[int] = None) -> None:
         """
         Initiliazes DataCollator.
 
         :param tokenizer: tokenizer
         :param mode: mode
         :param using_tpu: whether to use tpu or not
+        :param source_max_length: source length used to keep static shapes on tpu
+        :param target_max_length: target length used to keep static shapes on tpu
         """
 
         self.tokenizer = tokenizer
         self.using_tpu = using_tpu
         self.mode = mode
+        self.source_max_length = source_max_length
+        self.target_max_length = target_max_length
 
     def __call__(self, batch: List) -> Dict[str, torch.Tensor]:
         """
@@ -57,60 +64,28 @@ class DataCollator:
         :return: dictionary of tensors
         """
 
-        # Stacking elements
-        input_ids = torch.stack([example['source_ids'] for example in batch])
-        target_ids = torch.stack([example['target_ids'] for example in batch])
-        attention_mask = torch.stack([example['attention_mask'] for example in batch])
-
         # Setting pad token id
         pad_token_id = self.tokenizer.pad_token_id
 
-        # Preventing trim on TPU use
-        if not self.using_tpu:
-            input_ids, attention_mask = trim_batch(input_ids, pad_token_id, attention_mask=attention_mask)
-            target_ids = trim_batch(target_ids, pad_token_id)
+        # Padding to the longest sample, or to max length on TPU to prevent recompilations
+        source_length = self.source_max_length if self.using_tpu else None
+        target_length = self.target_max_length if self.using_tpu else None
 
-        # Shifting decoder inputs to the right
-        lm_labels = target_ids.clone()
-        decoder_input_ids = self._shift_right_mt5(lm_labels)
-        if self.mode == 'training':
-            lm_labels[lm_labels[:, :] == pad_token_id] = -100
+        # Padding labels with -100 in training so that padding is ignored by the loss
+        label_pad_id = -100 if self.mode == 'training' else pad_token_id
 
-        # Creating dictionary with results
+        input_ids = pad_batch([example['source_ids'] for example in batch], pad_token_id, source_length)
+        attention_mask = pad_batch([example['attention_mask'] for example in batch], 0, source_length)
+        labels = pad_batch([example['labels'] for example in batch], label_pad_id, target_length)
+        decoder_input_ids = pad_batch([example['decoder_input_ids'] for example in batch], pad_token_id,
+                                      target_length)
+
+        # Creating dictionary with results (loss expects int64 labels)
         params = {
             "input_ids": input_ids,
             "attention_mask": attention_mask,
-            "labels": lm_labels,
+            "labels": labels.long(),
             "decoder_input_ids": decoder_input_ids
         }
 
         return params
-
-    def _shift_right_mt5(self, input_ids):
-        """
-        Shifts inputs to the right.
-
-        :param input_ids:
-        :return:
-        """
-
-        # Setting pad token id
-        pad_token_id = self.tokenizer.pad_token_id
-
-        # Assertions to prevent bugs
-        assert pad_token_id is not None, \
-            "self.model.config.pad_token_id has to be defined."
-
-        # Shifting inputs to the right
-        shifted_input_ids = input_ids.new_zeros(input_ids.shape)
-        shifted_input_ids[..., 1:] = input_ids[..., :-1].clone()
-        shifted_input_ids[..., 0] = pad_token_id
-
-        # Replacing possible -100 values in labels by `pad_token_id`
-        shifted_input_ids.masked_fill_(shifted_input_ids == -100, pad_token_id)
-
-        # Assertions to make sure output is bugfree
-        assert torch.all(shifted_input_ids >= 0).item(), \
-            "Verify that `labels` has only positive values and -100"
-
-        return shifted_input_ids
@@ -6,20 +6,30 @@ Author: @DvdNss
 Created on 11/15/2021
 """
 
-import json
+import hashlib
 import logging
 import os
+import shutil
 from dataclasses import (
+    asdict,
     dataclass,
     field
 )
-from typing import Optional
+from typing import Iterator, Optional, Tuple
 
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
-from nlp import Dataset
+from datasets import (
+    Dataset,
+    Features,
+    Sequence,
+    Value,
+    concatenate_datasets
+)
+from pyarrow import csv
 from transformers import (
-    MT5Tokenizer,
+    MT5TokenizerFast,
     HfArgumentParser
 )
 
@@ -36,12 +46,28 @@ DEFAULT_ARGS = dict(
     valid_csv_path='data/valid.tsv',  # Validation file path
     source_column='source_text',  # Source column
     target_column='target_text',  # Target column
-    train_data_save_path='data/train.pt',  # Training data save path
-    valid_data_save_path='data/valid.pt',  # Validation data save path
-    databuilder_config_save_path='model/config/config.json'  # Save path of databuilder config
+    train_data_save_path='data/train.arrow',  # Training data save path
+    valid_data_save_path='data/valid.arrow',  # Validation data save path
+    databuilder_config_save_path='model/config/config.json',  # Save path of databuilder config
+    num_proc=max(1, (os.cpu_count() or 1) // 2),  # Number of processes used for tokenization
+    cache_dir='data/cache',  # Cache folder of built features
+    cache_max_entries=3  # Maximum number of cached feature sets
 )
 
 
+# Version of the features building logic, to increment whenever it changes so that cached features are rebuilt
+FEATURES_VERSION = 3
+
+# Features stored on disk, token ids fit in int32 (vocab < 2^31)
+FEATURES = Features({
+    'source_ids': Sequence(Value('int32')),
+    'labels': Sequence(Value('int32')),
+    'decoder_input_ids': Sequence(Value('int32')),
+    'attention_mask': Sequence(Value('int8')),
+    'length': Value('int32'),
+})
+
+
 @dataclass
 class DatabuilderArguments:
     """
@@ -81,17 +107,26 @@ class DatabuilderArguments:
     target_max_length: Optional[int] = field(default=DEFAULT_ARGS['target_max_length'],
                                              metadata={"help": "Maximum number of tokens in target. "})
 
+    num_proc: Optional[int] = field(default=DEFAULT_ARGS['num_proc'],
+                                    metadata={"help": "Number of processes used for tokenization. "})
+
+    cache_dir: Optional[str] = field(default=DEFAULT_ARGS['cache_dir'],
+                                     metadata={"help": "Cache folder of built features. "})
+
+    cache_max_entries: Optional[int] = field(default=DEFAULT_ARGS['cache_max_entries'],
+                                             metadata={"help": "Maximum number of cached feature sets. "})
+
 
 class Databuilder:
     """
     Data preprocessing and conversion.
     """
 
-    def __init__(self, tokenizer: MT5Tokenizer, args: DatabuilderArguments) -> None:
+    def __init__(self, tokenizer: MT5TokenizerFast, args: DatabuilderArguments) -> None:
         """
         Initializes Preprocessor.
 
-        :param tokenizer: MT5 Tokenizer
+        :param tokenizer: MT5 fast tokenizer
         :param args: databuilder arguments
         """
 
@@ -100,6 +135,7 @@ class Databuilder:
         self.target_max_length = args.target_max_length
         self.source_column = args.source_column
         self.target_column = args.target_column
+        self.num_proc = args.num_proc
 
     def preprocess(self, dataset: Dataset) -> Dataset:
         """
@@ -109,31 +145,36 @@ class Databuilder:
         :return: preprocessed dataset
         """
 
-        # Dataset preprocessing
-        dataset = dataset.map(self._add_eos)
-        dataset = dataset.map(self._to_features, batched=True)
+        # Dataset preprocessing, sharded across processes
+        dataset = dataset.map(
+            self._to_features,
+            batched=True,
+            batch_size=2000,
+            num_proc=self.num_proc,
+            remove_columns=dataset.column_names,
+            features=FEATURES
+        )
 
         return dataset
 
-    def _add_eos(self, row: dict) -> dict:
+    def from_tsv(self, path: str) -> Dataset:
         """
-        Adds end of sentence tokens if necessary.
+        Reads a tsv file block by block and converts it to features.
 
-        :param row: a data example
-        :return: modified data example
+        :param path: tsv file path
+        :return: preprocessed dataset
         """
 
-        row[self.source_column] = [
-            row[self.source_column] + " </s>",
-            row[self.source_column]
-        ][row[self.source_column][-4:] == '</s>']
+        # Preprocessing each block as soon as it is read
+        columns = [self.source_column, self.target_column]
+        parts = [self.preprocess(dataset=Dataset(strip_eos(table=table, columns=columns)))
+                 for table in read_tsv(path=path, columns=columns)]
 
-        row[self.target_column] = [
-            row[self.target_column] + " </s>",
-            row[self.target_column]
-        ][row[self.target_column][-4:] == '</s>']
+        # Returning empty features for files without rows
+        if not parts:
+            return Dataset.from_dict({name: [] for name in FEATURES}, features=FEATURES)
 
-        return row
+        return concatenate_datasets(parts)
 
     def _to_features(self, batch: dict) -> dict:
         """
@@ -144,33 +185,164 @@ class Databuilder:
         """
 
         # Generating encoded source with tokenizer
-        encoded_source = self.tokenizer.batch_encode_plus(
-            batch_text_or_text_pairs=batch[self.source_column],
+        encoded_source = self.tokenizer(
+            batch[self.source_column],
             max_length=self.source_max_length,
-            padding='max_length',
-            pad_to_max_length=True,
+            padding=False,
             truncation=True,
+            return_attention_mask=True,
         )
 
         # Generating encoded target with tokenizer
-        encoded_target = self.tokenizer.batch_encode_plus(
-            batch_text_or_text_pairs=batch[self.target_column],
+        encoded_target = self.tokenizer(
+            batch[self.target_column],
             max_length=self.target_max_length,
-            padding='max_length',
-            pad_to_max_length=True,
+            padding=False,
             truncation=True,
         )
 
+        # Shifting targets to the right to get decoder inputs
+        pad_token_id = self.tokenizer.pad_token_id
+        decoder_input_ids = [[pad_token_id] + target_ids[:-1] for target_ids in encoded_target['input_ids']]
+
         # Generating output dictionary
         encodings = {
             'source_ids': encoded_source['input_ids'],
-            'target_ids': encoded_target['input_ids'],
+            'labels': encoded_target['input_ids'],
+            'decoder_input_ids': decoder_input_ids,
             'attention_mask': encoded_source['attention_mask'],
+            'length': [len(source_ids) for source_ids in encoded_source['input_ids']],
         }
 
         return encodings
 
 
+def read_tsv(path: str, columns: list) -> Iterator[pa.Table]:
+    """
+    Streams given columns of a tsv file as arrow tables of about 64MB, parsing them as strings.
+
+    :param path: tsv file path
+    :param columns: columns to read as strings
+    :return: iterator over arrow tables
+    """
+
+    # Only including text columns so that other columns types can't break the stream
+    try:
+        reader = csv.open_csv(
+            path,
+            read_options=csv.ReadOptions(block_size=64 << 20),
+            parse_options=csv.ParseOptions(delimiter='\t'),
+            convert_options=csv.ConvertOptions(
+                column_types={column: pa.string() for column in columns},
+                include_columns=columns
+            )
+        )
+
+    # Reporting missing columns with the file they are missing from
+    except pa.ArrowKeyError as error:
+        raise AssertionError(f"{' or '.join(columns)} column missing in {path}.") from error
+
+    for batch in reader:
+        yield pa.Table.from_batches([batch])
+
+
+def strip_eos(table: pa.Table, columns: list) -> pa.Table:
+    """
+    Removes trailing end of sentence tokens from given columns, the fast tokenizer always adds one.
+
+    :param table: arrow table
+    :param columns: text columns
+    :return: table with texts not ending with an eos token
+    """
+
+    for column in columns:
+        texts = pc.replace_substring_regex(table[column], pattern=r'\s*</s>\s*$', replacement='')
+        table = table.set_column(table.column_names.index(column), column, texts)
+
+    return table
+
+
+def get_cache_path(args: DatabuilderArguments) -> str:
+    """
+    Gets the cache folder of features built from given files and arguments.
+
+    :param args: databuilder arguments
+    :return: cache folder path
+    """
+
+    # Hashing everything features depend on, files are identified by their path, mtime and size
+    key = [args.tokenizer_name_or_path, args.source_column, args.target_column,
+           args.source_max_length, args.target_max_length, sorted(FEATURES), FEATURES_VERSION]
+    for path in [args.train_csv_path, args.valid_csv_path]:
+        stat = os.stat(path)
+        key += [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+    return os.path.join(args.cache_dir, digest)
+
+
+def evict_cache(args: DatabuilderArguments) -> None:
+    """
+    Removes least recently used cached features beyond the maximum number of entries.
+
+    :param args: databuilder arguments
+    """
+
+    entries = [os.path.join(args.cache_dir, entry) for entry in os.listdir(args.cache_dir)]
+    entries = sorted([entry for entry in entries if os.path.isdir(entry)], key=os.path.getmtime, reverse=True)
+    for entry in entries[args.cache_max_entries:]:
+        shutil.rmtree(entry)
+        logger.info(f"Evicted cached features {entry}. ")
+
+
+def link_dataset(dataset_path: str, save_path: str) -> None:
+    """
+    Points a save path to a dataset folder, replacing whatever was saved there.
+
+    :param dataset_path: dataset folder
+    :param save_path: save path to link
+    """
+
+    if os.path.islink(save_path) or os.path.isfile(save_path):
+        os.remove(save_path)
+    elif os.path.isdir(save_path):
+        shutil.rmtree(save_path)
+
+    os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+    os.symlink(os.path.abspath(dataset_path), save_path, target_is_directory=True)
+
+
+def build_datasets(tokenizer: MT5TokenizerFast, args: DatabuilderArguments) -> Tuple[Dataset, Dataset]:
+    """
+    Reads training and validation files and converts them to features.
+
+    :param tokenizer: MT5 fast tokenizer
+    :param args: databuilder arguments
+    :return: training and validation datasets
+    """
+
+    # Checking whether training and validation data come from the same file
+    same_csv = os.path.abspath(args.train_csv_path) == os.path.abspath(args.valid_csv_path)
+
+    # Initializing preprocessor
+    preprocessor = Databuilder(
+        tokenizer=tokenizer,
+        args=args
+    )
+
+    # Preprocessing both files, reusing training features when both are the same
+    train_dataset = preprocessor.from_tsv(path=args.train_csv_path)
+    valid_dataset = train_dataset if same_csv else preprocessor.from_tsv(path=args.valid_csv_path)
+
+    # Changing datasets format, keeping int32 tensors since the torch formatter defaults to int64
+    columns = ["source_ids", "labels", "decoder_input_ids", "attention_mask"]
+    train_dataset.set_format(type='torch', columns=columns, dtype=torch.int32)
+    valid_dataset.set_format(type='torch', columns=columns, dtype=torch.int32)
+
+    return train_dataset, valid_dataset
+
+
 def main(from_json: bool = True, filename: str = DEFAULT_ARGS['databuilder_config_save_path']) -> None:
     """
     Building training and validation data.
@@ -192,61 +364,48 @@ def main(from_json: bool = True, filename: str = DEFAULT_ARGS['databuilder_confi
     db_args = parser.parse_json_file(json_file=filename)[0] if from_json else parser.parse_args_into_dataclasses()[0]
 
     # Showing config
-    with open(db_args.databuilder_config_save_path, "r") as config:
-        config = json.load(config)
+    config = asdict(db_args)
 
     logger.info("This config is being built: ")
     for key in sorted(config):
         logger.info("     " + key + "=" + str(config[key]))
 
-    # Loading dataframes
-    train_df = pd.read_csv(filepath_or_buffer=db_args.train_csv_path, sep='\t').astype(str)
-    valid_df = pd.read_csv(filepath_or_buffer=db_args.valid_csv_path, sep='\t').astype(str)
+    # Asserting save paths are arrow folders
+    assert all([db_args.train_data_save_path[-6:] == '.arrow',
+                db_args.valid_data_save_path[-6:] == '.arrow']), \
+        "train_data_save_path and valid_data_save_path must be .arrow folders."
 
-    # Assertions to prevent wasted time and annoying bugs coming from sensitive arguments
-    assert all([db_args.source_column in train_df.columns,
-                db_args.target_column in train_df.columns]), \
-        f"{db_args.source_column} or {db_args.target_column} column missing in {db_args.train_csv_path}."
-
-    assert all([db_args.source_column in valid_df.columns,
-                db_args.target_column in valid_df.columns]), \
-        f"{db_args.source_column} or {db_args.target_column} column missing in {db_args.valid_csv_path}."
-
-    assert all([db_args.train_data_save_path[-3:] == '.pt',
-                db_args.valid_data_save_path[-3:] == '.pt']), \
-        "train_data_save_path and valid_data_save_path must be .pt files."
-
-    # Building Datasets from dataframes
-    train_dataset = Dataset.from_pandas(train_df)
-    valid_dataset = Dataset.from_pandas(valid_df)
+    # Letting the Rust tokenizer use all cores only when tokenization is not already sharded across processes
+    os.environ["TOKENIZERS_PARALLELISM"] = "true" if db_args.num_proc == 1 else "false"
 
     # Loading tokenizer and adding special tokens
-    tokenizer = MT5Tokenizer.from_pretrained(db_args.tokenizer_name_or_path)
-
-    # Initializing preprocessor
-    preprocessor = Databuilder(
-        tokenizer=tokenizer,
-        args=db_args
-    )
-
-    # Preprocessing both datasets
-    train_dataset = preprocessor.preprocess(
-        dataset=train_dataset
-    )
-    valid_dataset = preprocessor.preprocess(
-        dataset=valid_dataset
-    )
-
-    # Changing datasets format
-    columns = ["source_ids", "target_ids", "attention_mask"]
-    train_dataset.set_format(type='torch', columns=columns)
-    valid_dataset.set_format(type='torch', columns=columns)
-
-    # Saving datasets
-    torch.save(train_dataset, db_args.train_data_save_path)
+    tokenizer = MT5TokenizerFast.from_pretrained(db_args.tokenizer_name_or_path)
+
+    # Building features unless they are cached
+    cache_path = get_cache_path(args=db_args)
+    if os.path.isdir(cache_path):
+        os.utime(cache_path)
+        logger.info(f"Features found in cache {cache_path}. ")
+    else:
+        train_dataset, valid_dataset = build_datasets(tokenizer=tokenizer, args=db_args)
+
+        # Caching features, the folder is renamed once complete so that interrupted builds are never reused
+        shutil.rmtree(cache_path + '.tmp', ignore_errors=True)
+        train_dataset.save_to_disk(os.path.join(cache_path + '.tmp', 'train'))
+        if valid_dataset is not train_dataset:
+            valid_dataset.save_to_disk(os.path.join(cache_path + '.tmp', 'valid'))
+        os.replace(cache_path + '.tmp', cache_path)
+        logger.info(f"Features cached at {cache_path}. ")
+
+        evict_cache(args=db_args)
+
+    # Linking save paths to cached features, validation reuses training features when built from the same file
+    valid_folder = 'valid' if os.path.isdir(os.path.join(cache_path, 'valid')) else 'train'
+
+    link_dataset(dataset_path=os.path.join(cache_path, 'train'), save_path=db_args.train_data_save_path)
     logger.info(f"Train dataset saved at {db_args.train_data_save_path}. ")
 
-    torch.save(valid_dataset, db_args.valid_data_save_path)
+    link_dataset(dataset_path=os.path.join(cache_path, valid_folder), save_path=db_args.valid_data_save_path)
     logger.info(f"Validation dataset saved at {db_args.valid_data_save_path}. ")
 
     # Saving tokenizer
@@ -6,7 +6,6 @@ Author: @DvdNss
 Created on 11/15/2021
 """
 
-import json
 import logging
 import os
 from dataclasses import dataclass, field
@@ -27,7 +26,10 @@ from source.train import (
     ModelArguments,
     DEFAULT_ARGS as model_config
 )
-from source.utils import dict_to_json
+from source.utils import (
+    dict_to_json,
+    json_to_dict,
+)
 
 # Initializing logger
 logger = logging.getLogger(__name__)
@@ -148,7 +150,7 @@ class ClassicPipeline(Pipeline):
 
     @staticmethod
     def _ready_for_task(text: str) -> str:
-        return f"task: {text} </s>"
+        return f"task: {text}"
 
 
 # Supported pipelines
@@ -211,8 +213,7 @@ def run(args_dict: dict = {}, model_config_path: str = model_config['model_confi
         f"Invalid filename for {model_config_path}, file doesn't exist. "
 
     # Opening databuilder config path and merging it with pipeline dict
-    with open(model_config_path, "r") as cfg:
-        args_dict = {**json.load(fp=cfg), **DEFAULT_ARGS, **args_dict}
+    args_dict = {**json_to_dict(filename=model_config_path), **DEFAULT_ARGS, **args_dict}
 
     # Writing file to json
     file = dict_to_json(args_dict=args_dict, filename=args_dict['pipeline_config_save_path'])
@@ -6,28 +6,32 @@ Author: @DvdNss
 Created on 11/15/2021
 """
 
-import json
 import logging
 import wandb
 import os
 from dataclasses import dataclass, field
 from typing import Optional
 
-import torch
+from datasets import load_from_disk
 from transformers import (
     AutoModelForSeq2SeqLM,
-    MT5Tokenizer,
+    MT5TokenizerFast,
     HfArgumentParser,
     TrainingArguments,
-    set_seed, Trainer,
+    set_seed,
 )
 from source.data_collator import DataCollator
 from source.databuilder import (
     DatabuilderArguments,
-    DEFAULT_ARGS as databuilder_config
+    DEFAULT_ARGS as databuilder_config,
+    get_cache_path,
+    run as run_databuilder
 )
+from source.trainer import Trainer
 from source.utils import (
     dict_to_json,
+    get_size,
+    json_to_dict,
 )
 
 # Initializing logger
@@ -38,7 +42,10 @@ DEFAULT_ARGS = dict(
     model_name_or_path="",
     model_config_save_path="model/config/config.json",
     wandb_project_name='mt5-project',
-    overwrite_output_dir=True
+    overwrite_output_dir=True,
+    group_by_length=True,
+    logging_nan_inf_filter=False,
+    dataloader_persistent_workers=True
 )
 
 
@@ -81,6 +88,9 @@ def main(from_json: bool = True, filename: str = DEFAULT_ARGS['model_config_save
         raise ValueError(f"Output directory ({training_args.output_dir}) already exists and is not empty. "
                          f"Use --overwrite_output_dir to overcome. ")
 
+    # Keeping databuilder columns for the data collator
+    training_args.remove_unused_columns = False
+
     # Logging the session informations
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
@@ -88,17 +98,17 @@ def main(from_json: bool = True, filename: str = DEFAULT_ARGS['model_config_save
         level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
     )
     logger.warning(
-        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
+        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, fp16 training: %s, bf16 training: %s",
         training_args.local_rank,
         training_args.device,
         training_args.n_gpu,
         bool(training_args.local_rank != -1),
         training_args.fp16,
+        training_args.bf16,
     )
 
     # Showing config
-    with open(model_args.model_config_save_path, "r") as config:
-        config = json.load(config)
+    config = json_to_dict(filename=model_args.model_config_save_path)
 
     logger.info("The model is being trained with the following parameters: ")
     for key in sorted(config):
@@ -114,29 +124,28 @@ def main(from_json: bool = True, filename: str = DEFAULT_ARGS['model_config_save
     wandb.init(
         project=model_args.wandb_project_name,
         name=f'model:{model_args.model_name_or_path}|'
-             f'dataset:{int(os.path.getsize(databuilder_args.train_data_save_path)/1000000)}MB|'
+             f'dataset:{int(get_size(databuilder_args.train_data_save_path)/1000000)}MB|'
              f'batch:{training_args.per_device_train_batch_size}'
     )
 
     # Getting model name
-    model_name = [
-        lambda: databuilder_args.tokenizer_name_or_path,
-        lambda: model_args.model_name_or_path
-    ][model_args.model_name_or_path != ""]()
+    model_name = model_args.model_name_or_path if model_args.model_name_or_path != "" \
+        else databuilder_args.tokenizer_name_or_path
 
     # Loading pretrained model and tokenizer
-    tokenizer = MT5Tokenizer.from_pretrained(databuilder_args.tokenizer_save_path)
+    tokenizer = MT5TokenizerFast.from_pretrained(databuilder_args.tokenizer_save_path)
     model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
 
-    # Resizing embedding
-    model.resize_token_embeddings(len(tokenizer))
+    # Resizing embedding only if it doesn't match the tokenizer
+    if model.get_input_embeddings().weight.shape[0] != len(tokenizer):
+        model.resize_token_embeddings(len(tokenizer))
 
     # Loading datasets
     logger.info('Loading datasets...')
 
-    train_dataset = torch.load(databuilder_args.train_data_save_path)
+    train_dataset = load_from_disk(databuilder_args.train_data_save_path)
     logger.info(f'{databuilder_args.train_data_save_path} has been loaded. ')
-    valid_dataset = torch.load(
+    valid_dataset = load_from_disk(
         databuilder_args.valid_data_save_path) if training_args.evaluation_strategy != "no" else None
     logger.info(f'{databuilder_args.valid_data_save_path} has been loaded. ')
 
@@ -144,7 +153,9 @@ def main(from_json: bool = True, filename: str = DEFAULT_ARGS['model_config_save
     data_collator = DataCollator(
         tokenizer=tokenizer,
         mode="training",
-        using_tpu=training_args.tpu_num_cores is not None)
+        using_tpu=training_args.tpu_num_cores is not None,
+        source_max_length=databuilder_args.source_max_length,
+        target_max_length=databuilder_args.target_max_length)
 
     # Initialize our Trainer
     trainer = Trainer(
@@ -184,8 +195,15 @@ def run(args_dict: dict = {},
         f"Invalid filename for {databuilder_config_path}, file doesn't exist. "
 
     # Opening databuilder config path and merging it with train dict
-    with open(databuilder_config_path, "r") as dbcfg:
-        args_dict = {**json.load(fp=dbcfg), **DEFAULT_ARGS, **args_dict}
+    databuilder_dict = json_to_dict(filename=databuilder_config_path)
+    args_dict = {**databuilder_dict, **DEFAULT_ARGS, **args_dict}
+
+    # Building features beforehand if training files changed and are not cached
+    databuilder_dict = {key: value for key, value in databuilder_dict.items() if key in databuilder_config}
+    databuilder_args = DatabuilderArguments(**databuilder_dict)
+    if (all(os.path.isfile(path) for path in [databuilder_args.train_csv_path, databuilder_args.valid_csv_path])
+            and not os.path.isdir(get_cache_path(args=databuilder_args))):
+        run_databuilder(args_dict=databuilder_dict)
 
     # Sending train dict to .json
     file = dict_to_json(args_dict=args_dict, filename=args_dict['model_config_save_path'])
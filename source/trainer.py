@@ -0,0 +1,150 @@
+# coding:utf-8
+"""
+Filename: trainer.py
+Author: @DvdNss
+
+Created on 10/15/2026
+"""
+
+import logging
+from functools import partial
+from inspect import signature
+from typing import Any, Dict, Tuple, Union
+
+import torch
+from torch.nn.functional import cross_entropy
+from torch.utils.data import DataLoader
+from transformers import (
+    PreTrainedModel,
+    Trainer as HFTrainer
+)
+from transformers.trainer_utils import seed_worker
+
+# Initializing logger
+logger = logging.getLogger(__name__)
+
+
+class Trainer(HFTrainer):
+    """
+    Hugging Face Trainer overlapping data loading with training.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        """
+        Initializes Trainer.
+
+        :param args: Hugging Face Trainer args
+        :param kwargs: Hugging Face Trainer kwargs
+        """
+
+        super().__init__(*args, **kwargs)
+
+        # Side stream used to copy inputs to GPU while the previous step computes
+        self._copy_stream = torch.cuda.Stream(device=self.args.device) if self.args.device.type == 'cuda' else None
+
+        # Checking the loss every step synchronizes with the GPU, preventing copies from overlapping with compute
+        if self._copy_stream is not None and self.args.logging_nan_inf_filter:
+            logger.warning("logging_nan_inf_filter synchronizes with the GPU every step, disable it so that input "
+                           "copies overlap with compute. ")
+
+    def get_train_dataloader(self) -> DataLoader:
+        """
+        Returns the training dataloader with pinned memory and worker prefetching.
+
+        :return: training dataloader
+        """
+
+        if self.train_dataset is None:
+            raise ValueError("Trainer: training requires a train_dataset.")
+
+        # Prefetching and persistent workers are only available with worker processes
+        num_workers = self.args.dataloader_num_workers
+        worker_kwargs = dict(
+            prefetch_factor=getattr(self.args, 'dataloader_prefetch_factor', None) or 4,
+            persistent_workers=getattr(self.args, 'dataloader_persistent_workers', True)
+        ) if num_workers > 0 else {}
+
+        # Seeding workers for reproducibility, recent transformers versions also need workers count and rank
+        worker_init_fn = partial(seed_worker, num_workers=num_workers, rank=self.args.process_index) \
+            if 'num_workers' in signature(seed_worker).parameters else seed_worker
+
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_size=self._train_batch_size,
+            sampler=self._get_train_sampler(),
+            collate_fn=self.data_collator,
+            drop_last=self.args.dataloader_drop_last,
+            num_workers=num_workers,
+            pin_memory=self.args.dataloader_pin_memory and self.args.device.type == 'cuda',
+            worker_init_fn=worker_init_fn,
+            **worker_kwargs
+        )
+
+        # Letting accelerate shard the dataloader on recent transformers versions, without moving batches to device
+        # so that pinned batches are copied on the copy stream by _prepare_inputs
+        if hasattr(self, 'accelerator'):
+            return self.accelerator.prepare_data_loader(dataloader, device_placement=False)
+
+        return dataloader
+
+    def _prepare_input(self, data: Any) -> Any:
+        """
+        Sends tensors to device without blocking on pinned memory.
+
+        :param data: input data
+        :return: input data on device
+        """
+
+        if isinstance(data, torch.Tensor):
+            return data.to(self.args.device, non_blocking=True)
+
+        return super()._prepare_input(data)
+
+    def _prepare_inputs(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Sends inputs to device on the copy stream when using GPU.
+
+        :param inputs: batch of inputs
+        :return: batch of inputs on device
+        """
+
+        if self._copy_stream is None:
+            return super()._prepare_inputs(inputs)
+
+        # Copying inputs on the side stream and making compute wait for the copy
+        with torch.cuda.stream(self._copy_stream):
+            inputs = super()._prepare_inputs(inputs)
+        torch.cuda.current_stream().wait_stream(self._copy_stream)
+
+        # Preventing the allocator from reusing inputs memory before compute is done
+        for value in inputs.values():
+            if isinstance(value, torch.Tensor):
+                value.record_stream(torch.cuda.current_stream())
+
+        return inputs
+
+    def compute_loss(self, model: PreTrainedModel, inputs: Dict[str, Any], return_outputs: bool = False,
+                     **kwargs) -> Union[torch.Tensor, Tuple[torch.Tensor, Any]]:
+        """
+        Computes the loss, applying label smoothing with torch cross entropy.
+
+        :param model: model being trained
+        :param inputs: batch of inputs
+        :param return_outputs: whether to return model outputs or not
+        :return: loss and eventually model outputs
+        """
+
+        if self.args.label_smoothing_factor == 0:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs, **kwargs)
+
+        # Getting logits only, decoder inputs are already provided by the data collator
+        labels = inputs.pop("labels")
+        outputs = model(**inputs)
+        logits = outputs["logits"]
+
+        # Smoothing labels inside cross_entropy, which still computes the full log-softmax but skips the extra
+        # Python-side masking and reductions of the Hugging Face LabelSmoother
+        loss = cross_entropy(logits.view(-1, logits.size(-1)), labels.view(-1), ignore_index=-100,
+                             label_smoothing=self.args.label_smoothing_factor)
+
+        return (loss, outputs) if return_outputs else loss
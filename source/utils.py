@@ -6,9 +6,10 @@ Author: @DvdNss
 Created on 11/15/2021
 """
 
-import json
 import os
 
+import orjson
+
 
 def dict_to_json(args_dict: dict, filename: str) -> str:
     """
@@ -25,7 +26,33 @@ def dict_to_json(args_dict: dict, filename: str) -> str:
     os.makedirs(os.path.dirname(filename), exist_ok=True)
 
     # Saving the config as json file
-    with open(filename, 'w') as config:
-        json.dump(args_dict, config, indent=2)
+    with open(filename, 'wb') as config:
+        config.write(orjson.dumps(args_dict, option=orjson.OPT_INDENT_2))
 
     return filename
+
+
+def json_to_dict(filename: str) -> dict:
+    """
+    Loads a json file as a dictionnary.
+
+    :param filename: json file name
+    :return: loaded dictionnary
+    """
+
+    with open(filename, 'rb') as config:
+        return orjson.loads(config.read())
+
+
+def get_size(path: str) -> int:
+    """
+    Gets the size of a file or of all files in a folder.
+
+    :param path: file or folder path
+    :return: size in bytes
+    """
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)